@@ -0,0 +1,55 @@
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+import albumentations as A
+
+from dataset_ensemble import MaskBaseDataset
+
+
+def build_cache(data_dir, cache_dir, img_size=(224, 224)):
+    """
+    data_dir 의 모든 학습 이미지를 한 번만 decode + resize 해서 cache_dir 에 저장합니다.
+        - images.npy : (N, H, W, 3) uint8 배열 (np.load(..., mmap_mode='r') 로 memmap 으로 읽습니다)
+        - image_paths.npy : 각 row 에 해당하는 data_dir 기준 상대 경로 (profile/file_name)
+    label 은 저장하지 않고 dataset 의 setup() 이 profile 이름에서 계산합니다.
+    """
+    rel_paths = []
+    for profile in sorted(os.listdir(data_dir)):
+        if profile.startswith("."):  # "." 로 시작하는 파일은 무시합니다
+            continue
+
+        for file_name in sorted(os.listdir(os.path.join(data_dir, profile))):
+            _file_name, ext = os.path.splitext(file_name)
+            if _file_name not in MaskBaseDataset._file_names:  # "." 로 시작하는 파일 및 invalid 한 파일들은 무시합니다
+                continue
+
+            rel_paths.append(os.path.join(profile, file_name))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    resize = A.Resize(*img_size, p=1.0)
+    mm = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                   shape=(len(rel_paths), *img_size, 3))
+    for idx, rel_path in enumerate(rel_paths):
+        image = np.array(Image.open(os.path.join(data_dir, rel_path)).convert('RGB'))
+        mm[idx] = resize(image=image)['image']
+    mm.flush()
+
+    np.save(os.path.join(cache_dir, 'image_paths.npy'), np.array(rel_paths))
+    print(f'Cached {len(rel_paths)} images to {cache_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--resize', nargs=2, type=int, default=[224, 224], help='resize size for cached images (default: 224 224)')
+
+    # Container environment
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images'))
+    parser.add_argument('--cache_dir', type=str, default='/opt/ml/input/data/train/cache')
+
+    args = parser.parse_args()
+
+    build_cache(args.data_dir, args.cache_dir, tuple(args.resize))
@@ -9,6 +9,7 @@ import torch
 from PIL import Image
 from torch.utils.data import Dataset, Subset, random_split
 from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_image, read_file
 from torchvision.transforms import *
 
 import albumentations as A
@@ -24,6 +25,15 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
 
 
+def collate_encoded(batch):
+    """
+        encoded=True 인 dataset 용 collate_fn 입니다.
+        JPEG byte 길이가 sample 마다 다르므로 stack 하지 않고 list 로 넘깁니다.
+    """
+    images, labels = zip(*batch)
+    return list(images), torch.tensor(labels)
+
+
 class BaseAugmentation:
     def __init__(self, resize, mean, std, **args):
         self.transform = transforms.Compose([
@@ -126,13 +136,22 @@ class MaskBaseDataset(Dataset):
     gender_labels = []
     age_labels = []
 
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2,cv=1):
+    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2,cv=1, encoded=False, cache_dir=None):
         self.data_dir = data_dir
         self.mean = mean
         self.std = std
         self.val_ratio = val_ratio
         self.cv= cv
+        self.encoded = encoded  # True 이면 JPEG 은 decode 하지 않은 byte 를 반환합니다 (GPU 에서 decode)
+        self.cache_dir = cache_dir  # cache_ensemble.py 로 만든 memmap 이 있으면 디스크 대신 사용합니다
+        self._cache = None
+        self._cache_rows = None
         self.transform = None
+        # instance 마다 새 list 를 만들어야 같은 process 에서 만든 다른 fold 의 dataset 과 섞이지 않습니다
+        self.image_paths = []
+        self.mask_labels = []
+        self.gender_labels = []
+        self.age_labels = []
         self.setup()
         self.calc_statistics()
 
@@ -178,17 +197,29 @@ class MaskBaseDataset(Dataset):
         self.transform = transform
 
     def __getitem__(self, index):
-        image = self.read_image(index)
+        return self.get_item(index, self.transform)
+
+    def get_item(self, index, transform):
         mask_label = self.get_mask_label(index)
         gender_label = self.get_gender_label(index)
         age_label = self.get_age_label(index)
         multi_class_label = self.encode_multi_class(mask_label, gender_label, age_label)
+
+        if self.encoded:
+            return self.read_encoded_image(index), multi_class_label
+
+        if self.cache_dir is not None:
+            # cache 는 이미 resize 되어 있으므로 worker 는 slice 만 하고 augmentation 은 GPU 에서 합니다
+            image = self.read_cached_image(self.image_paths[index])
+            return torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1), multi_class_label
+
+        image = self.read_image(index)
         
         # torchvision aug
-#         image_transform = self.transform(image)
+#         image_transform = transform(image)
         
         # albumentations
-        image_transform = self.transform(image=np.array(image))['image']
+        image_transform = transform(image=np.array(image))['image']
         return image_transform, multi_class_label
 
     def __len__(self):
@@ -207,6 +238,20 @@ class MaskBaseDataset(Dataset):
         image_path = self.image_paths[index]
         return Image.open(image_path)
 
+    def read_encoded_image(self, index):
+        data = read_file(self.image_paths[index])
+        if data[:2].tolist() != [0xFF, 0xD8]:  # JPEG 가 아닌 파일(png 등)은 nvJPEG 를 쓸 수 없으므로 CPU 에서 decode 한 (3, H, W) uint8 을 반환합니다
+            data = decode_image(data, mode=ImageReadMode.RGB)
+        return data
+
+    def read_cached_image(self, image_path):
+        # memmap 은 worker 안에서 처음 접근할 때 열어서 pickle 로 배열 전체가 복사되지 않게 합니다
+        if self._cache is None:
+            rel_paths = np.load(os.path.join(self.cache_dir, 'image_paths.npy'))
+            self._cache_rows = {rel_path: row for row, rel_path in enumerate(rel_paths)}
+            self._cache = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='r')
+        return self._cache[self._cache_rows[os.path.relpath(image_path, self.data_dir)]]
+
     @staticmethod
     def encode_multi_class(mask_label, gender_label, age_label) -> int:
         return mask_label * 6 + gender_label * 3 + age_label
@@ -231,7 +276,7 @@ class MaskBaseDataset(Dataset):
         n_val = int(len(self) * self.val_ratio)
         n_train = len(self) - n_val
         train_set, val_set = random_split(self, [n_train, n_val])
-        return train_set, val_set
+        return TransformSubset(self, train_set.indices), TransformSubset(self, val_set.indices)
 
 
 class MaskSplitByProfileDataset(MaskBaseDataset):
@@ -242,9 +287,9 @@ class MaskSplitByProfileDataset(MaskBaseDataset):
         이후 `split_dataset` 에서 index 에 맞게 Subset 으로 dataset 을 분기합니다.
     """
 
-    def __init__(self, data_dir, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), val_ratio=0.2, cv=1):
+    def __init__(self, data_dir, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), val_ratio=0.2, cv=1, encoded=False, cache_dir=None):
         self.indices = defaultdict(list)
-        super().__init__(data_dir, mean, std, val_ratio,cv)
+        super().__init__(data_dir, mean, std, val_ratio,cv, encoded, cache_dir)
 
     @staticmethod
     def _split_profile(profiles, val_ratio,cv):
@@ -289,7 +334,28 @@ class MaskSplitByProfileDataset(MaskBaseDataset):
                     cnt += 1
 
     def split_dataset(self) -> List[Subset]:
-        return [Subset(self, indices) for phase, indices in self.indices.items()]
+        return [TransformSubset(self, indices) for phase, indices in self.indices.items()]
+
+
+class TransformSubset(Subset):
+    """
+        train / val split 마다 transform 을 따로 가지는 Subset 입니다.
+        원본 dataset 의 transform 을 공유하지 않으므로 train / val 이 서로의 transform 을 덮어쓰지 않습니다.
+    """
+
+    def __init__(self, dataset, indices, transform=None):
+        super().__init__(dataset, indices)
+        self.transform = transform
+
+    def set_transform(self, transform):
+        self.transform = transform
+
+    def __getitem__(self, idx):
+        return self.dataset.get_item(self.indices[idx], self.transform)
+
+    def __getitems__(self, indices):
+        # Subset.__getitems__ (torch >= 2.1) 는 원본 dataset 을 직접 indexing 해서 split 의 transform 을 건너뜁니다
+        return [self[idx] for idx in indices]
 
 
 class TestDataset(Dataset):
@@ -5,6 +5,7 @@ import multiprocessing
 import os
 import random
 import re
+import time
 from importlib import import_module
 from pathlib import Path
 
@@ -14,21 +15,25 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.multiprocessing as mp
 import torchvision.models as models
 from torch.optim.lr_scheduler import StepLR
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from efficientnet_pytorch import EfficientNet
-from sklearn.metrics import f1_score, classification_report
+from sklearn.metrics import f1_score, classification_report, precision_recall_fscore_support
 
 import torchvision
 from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_jpeg
 from torchvision.transforms import *
 
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
+import kornia.augmentation as K
 
-from dataset_ensemble import MaskBaseDataset, MaskSplitByProfileDataset
+from dataset_ensemble import MaskBaseDataset, MaskSplitByProfileDataset, collate_encoded
 from loss import create_criterion
 
 # ========== Error analysis code ==========
@@ -40,15 +45,12 @@ def save_best_val_pred(y_true:np.array, y_pred:np.array, dir_model:str):
     df_val_pred.to_csv(dir_model + '/pred_result.csv', index=False)   
 
 
-def save_f1_result(epoch:int, report:dict, dir_model:str, save_best=True):
-    df_f1_rslt = pd.DataFrame(columns=['precision', 'recall', 'f1'],
-                              index=np.arange(0, 18),
+def save_f1_result(epoch:int, precision:np.array, recall:np.array, f1:np.array, dir_model:str, save_best=True):
+    df_f1_rslt = pd.DataFrame({'precision': precision,
+                               'recall': recall,
+                               'f1': f1},
                               dtype=np.float32
-                              )
-    
-    for idx in df_f1_rslt.index:
-        k = str(idx)
-        df_f1_rslt.loc[idx, :] = report[k]['precision'], report[k]['recall'], report[k]['f1-score']
+                             )
     
     if save_best:
         df_f1_rslt.to_csv(dir_model + '/f1_result.csv', index=False) 
@@ -56,12 +58,13 @@ def save_f1_result(epoch:int, report:dict, dir_model:str, save_best=True):
         df_f1_rslt.to_csv(dir_model + f'/f1_result_epoch_{epoch}.csv', index=False) 
 # ========== Error analysis code ==========
 
-def seed_everything(seed):
+def seed_everything(seed, deterministic=True):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)  # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # deterministic for evaluation, cudnn autotuner for training (input shape is fixed by drop_last=True)
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
     np.random.seed(seed)
     random.seed(seed)
 
@@ -101,21 +104,40 @@ def grid_image(np_images, gts, preds, n=16, shuffle=False):
 
     return figure
 
-def select_model(model, num_classes=18):
-    if model == 'resnet18':
-        model_ = models.resnet18(pretrained=True)
-        model_.classifier = nn.Linear(1024, num_classes)
-    elif model == 'densenet161':
-        model_ = models.densenet161(pretrained=True)
-        model_.classifier = nn.Linear(2208, num_classes)
-    elif model == 'shufflenet':
-        model_ = torch.hub.load('pytorch/vision:v0.10.0', 'shufflenet_v2_x1_0', pretrained=True)
-        model_.fc = nn.Linear(1024, num_classes)
-    elif model == 'efficientnet':
-        model_ = EfficientNet.from_pretrained('efficientnet-b0',num_classes=num_classes)
+def _resnet18(num_classes):
+    model_ = models.resnet18(pretrained=True)
+    model_.fc = nn.Linear(model_.fc.in_features, num_classes)
+    return model_
+
+
+def _densenet161(num_classes):
+    model_ = models.densenet161(pretrained=True)
+    model_.classifier = nn.Linear(model_.classifier.in_features, num_classes)
+    return model_
+
+
+def _shufflenet(num_classes):
+    model_ = torch.hub.load('pytorch/vision:v0.10.0', 'shufflenet_v2_x1_0', pretrained=True)
+    model_.fc = nn.Linear(model_.fc.in_features, num_classes)
     return model_
 
 
+def _efficientnet(num_classes):
+    return EfficientNet.from_pretrained('efficientnet-b0', num_classes=num_classes)
+
+
+_MODELS = {
+    'resnet18': _resnet18,
+    'densenet161': _densenet161,
+    'shufflenet': _shufflenet,
+    'efficientnet': _efficientnet,
+}
+
+
+def select_model(model, num_classes=18):
+    return _MODELS[model](num_classes)
+
+
 def increment_path(path, exist_ok=False):
     """ Automatically increment path, i.e. runs/exp --> runs/exp0, runs/exp1 etc.
 
@@ -124,14 +146,12 @@ def increment_path(path, exist_ok=False):
         exist_ok (bool): whether increment path (increment if False).
     """
     path = Path(path)
-    if (path.exists() and exist_ok) or (not path.exists()):
+    if not path.exists() or exist_ok:
         return str(path)
-    else:
-        dirs = glob.glob(f"{path}*")
-        matches = [re.search(rf"%s(\d+)" % path.stem, d) for d in dirs]
-        i = [int(m.groups()[0]) for m in matches if m]
-        n = max(i) + 1 if i else 2
-        return f"{path}{n}"
+    pattern = re.compile(rf"{re.escape(path.stem)}(\d+)$")
+    i = [int(m.group(1)) for d in glob.iglob(f"{path}*") if (m := pattern.search(Path(d).name))]
+    n = max(i) + 1 if i else 2
+    return f"{path}{n}"
 
 # torchvision transform
 # def get_transforms(need=('train', 'val'), img_size=(512, 384)):
@@ -154,74 +174,207 @@ def increment_path(path, exist_ok=False):
     
 # albumentations    
 def get_transforms(need=('train', 'val'), img_size=(512, 384)):
+    # for the plain (not encoded, not cached) dataset path : workers only resize and hand over uint8 tensors,
+    # augmentation/normalization runs on GPU (see get_gpu_transforms)
     transformations = {}
     if 'train' in need:
         transformations['train'] = A.Compose([
             A.Resize(224,224, p=1.0),
-            A.HorizontalFlip(p=0.5),
-            A.ShiftScaleRotate(p=0.5,rotate_limit=15),
-#             A.HueSaturationValue(hue_shift_limit=0.2, sat_shift_limit=0.2, val_shift_limit=0.2, p=0.5),
-#             A.RandomBrightnessContrast(brightness_limit=(-0.1, 0.1), contrast_limit=(-0.1, 0.1), p=0.5),
-#             A.GaussNoise(p=0.5),
-            A.CoarseDropout(max_holes=20,p=1),
-            A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], max_pixel_value=255.0, p=1.0),
             ToTensorV2(p=1.0),
         ], p=1.0)
     if 'val' in need:
         transformations['val'] = A.Compose([
             A.Resize(224,224, p=1.0),
-            A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], max_pixel_value=255.0, p=1.0),
             ToTensorV2(p=1.0),
         ], p=1.0)
     return transformations    
 
+# kornia
+def get_gpu_transforms(need=('train', 'val'), mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+    mean = torch.tensor(mean)
+    std = torch.tensor(std)
+    transformations = {}
+    if 'train' in need:
+        transformations['train'] = K.AugmentationSequential(
+            K.RandomHorizontalFlip(p=0.5),
+            # ShiftScaleRotate(rotate_limit=15) with its BORDER_REFLECT_101 padding
+            K.RandomAffine(degrees=15, translate=(0.0625, 0.0625), scale=(0.9, 1.1), padding_mode='reflection', p=0.5),
+            # CoarseDropout(max_holes=20) blanked 20 8x8 holes, ~2.5% of a 224x224 image
+            K.RandomErasing(scale=(0.02, 0.03), p=1.0),
+            K.Normalize(mean=mean, std=std),
+            same_on_batch=False,
+        )
+    if 'val' in need:
+        transformations['val'] = K.AugmentationSequential(
+            K.Normalize(mean=mean, std=std),
+        )
+    return transformations
+
+def decode_batch(encoded, device, size=(224, 224)):
+    """ Decode a list of JPEG byte tensors on `device` (nvJPEG on CUDA) and resize them to `size`.
+
+    Non-JPEG samples arrive already decoded on CPU as (3, H, W) uint8 and are only moved to `device`.
+    Resizing is plain bilinear without antialiasing to match A.Resize used by the cache and TestDataset.
+
+    Returns:
+        float NCHW tensor in [0, 255].
+    """
+    images = [data.to(device, non_blocking=True) if data.dim() == 3 else None for data in encoded]
+    jpeg_idx = [k for k, data in enumerate(encoded) if data.dim() == 1]
+    if jpeg_idx:
+        decoded = decode_jpeg([encoded[k] for k in jpeg_idx], mode=ImageReadMode.RGB, device=device)
+        for k, img in zip(jpeg_idx, decoded):
+            images[k] = img
+    if len({img.shape for img in images}) == 1:
+        return F.interpolate(torch.stack(images).float(), size=size, mode='bilinear', align_corners=False, antialias=False)
+    return torch.cat([
+        F.interpolate(img.unsqueeze(0).float(), size=size, mode='bilinear', align_corners=False, antialias=False)
+        for img in images
+    ])
+
+
+def inputs_to_device(inputs, device):
+    """ Move a collated batch to `device` as a float NCHW tensor in [0, 255].
+
+    Args:
+        inputs: list of encoded JPEG tensors (decoded on device) or uint8 NCHW tensor from the memmap cache.
+    """
+    if isinstance(inputs, list):
+        return decode_batch(inputs, device)
+    return inputs.to(device, non_blocking=True).float()
+
+
+def tune_num_workers(dataset, candidate_list, batch_size=64, num_batches=20, pin_memory=False, collate_fn=None):
+    """ Pick the num_workers that loads `num_batches` batches the fastest.
+
+    Args:
+        dataset (TransformSubset): split returned by `split_dataset`, measured with its own transform.
+        candidate_list (list of int): num_workers values to try.
+    """
+    elapsed = {}
+    for num_workers in candidate_list:
+        loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            shuffle=False,  # read cost doesn't depend on order
+            pin_memory=pin_memory,
+            drop_last=True,
+            collate_fn=collate_fn,
+            generator=torch.Generator(),  # worker base seed is drawn from here, not from the seeded global RNG
+        )
+        it = iter(loader)
+        start = None
+        for _ in range(num_batches + 1):
+            try:
+                next(it)
+            except StopIteration:
+                break
+            if start is None:
+                start = time.perf_counter()  # exclude worker start-up (first batch), workers are persistent during training
+        elapsed[num_workers] = time.perf_counter() - start if start is not None else float('inf')
+        del it, loader
+        print(f"num_workers {num_workers} || {elapsed[num_workers]:.3f}s / {num_batches} batches")
+    return min(elapsed, key=elapsed.get)
+
+
 def train(data_dir, model_dir, args):
-    seed_everything(args.seed)
+    """ Run the 5 CV folds, one process per GPU when several GPUs are available.
 
-    # -- settings
-    use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+    Folds are independent, so each process trains its own folds on its own GPU
+    (no gradient sync / DistributedSampler involved).
+    """
+    num_folds = 5
+    world_size = min(num_folds, torch.cuda.device_count()) if torch.cuda.is_available() else 1
 
-    # -- start K-fold cross-validation
-    for i in range(5):
+    # save dirs are reserved up front so that concurrent folds don't race in increment_path
+    save_dirs = []
+    for i in range(num_folds):
         save_dir = increment_path(os.path.join(model_dir, args.name))
-        dataset = MaskSplitByProfileDataset(data_dir=data_dir,cv=i)
+        os.makedirs(save_dir)
+        save_dirs.append(save_dir)
+
+    if world_size > 1:
+        mp.spawn(train_folds, args=(world_size, data_dir, save_dirs, args), nprocs=world_size)
+    else:
+        train_folds(0, 1, data_dir, save_dirs, args)
+
+
+def train_folds(rank, world_size, data_dir, save_dirs, args):
+    seed_everything(args.seed, deterministic=False)
+    torch.set_float32_matmul_precision('high')  # TF32 matmuls on Ampere+
+
+    # -- settings
+    use_cuda = torch.cuda.is_available()
+    device = torch.device(f"cuda:{rank}" if use_cuda else "cpu")
+    if use_cuda:
+        torch.cuda.set_device(rank)
+    # bf16 has the fp32 exponent range (Ampere+), so no GradScaler is needed
+    use_bf16 = use_cuda and torch.cuda.is_bf16_supported(including_emulation=False)
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+
+    cpu_count = multiprocessing.cpu_count() // world_size  # CPUs are shared by the concurrent folds
+    worker_candidates = sorted({n for n in (2, 4, 8, cpu_count // 2) if 0 < n <= cpu_count}) or [1]
+    num_workers = None  # tuned on the first fold, reused for the rest
+
+    # -- start K-fold cross-validation, fold i runs on GPU i % world_size
+    for i in range(rank, len(save_dirs), world_size):
+        save_dir = save_dirs[i]
+        # memmap cache 가 있으면 worker 는 slice 만, 없으면 JPEG byte 만 읽고 GPU 에서 decode 합니다
+        use_cache = args.cache_dir is not None
+        collate_fn = None if use_cache else collate_encoded
+        dataset = MaskSplitByProfileDataset(data_dir=data_dir,cv=i,encoded=not use_cache,cache_dir=args.cache_dir)
         num_classes = dataset.num_classes  # 18
 
         # -- data_loader
-        transform = get_transforms()
+        gpu_transform = {k: v.to(device) for k, v in get_gpu_transforms(mean=dataset.mean, std=dataset.std).items()}
         train_set, val_set = dataset.split_dataset()
+        if num_workers is None:
+            num_workers = tune_num_workers(train_set, worker_candidates,
+                                           batch_size=args.batch_size, pin_memory=use_cuda, collate_fn=collate_fn)
+            print(f"num_workers : {num_workers}")
 
         train_loader = DataLoader(
             train_set,
             batch_size=args.batch_size,
-            num_workers=multiprocessing.cpu_count()//2,
+            num_workers=num_workers,
             shuffle=True,
             pin_memory=use_cuda,
             drop_last=True,
+            persistent_workers=True,
+            prefetch_factor=2,
+            collate_fn=collate_fn,
         )
 
         val_loader = DataLoader(
             val_set,
             batch_size=args.valid_batch_size,
-            num_workers=multiprocessing.cpu_count()//2,
+            num_workers=num_workers,
             shuffle=False,
             pin_memory=use_cuda,
             drop_last=True,
+            persistent_workers=True,
+            prefetch_factor=2,
+            collate_fn=collate_fn,
         )
 
         model = select_model('efficientnet', 18).to(device)
-        scaler = torch.cuda.amp.GradScaler()
+        model = model.to(memory_format=torch.channels_last)
+        # compiled_model shares parameters with model, state_dict is saved from model to keep checkpoint keys unchanged
+        compiled_model = torch.compile(model, mode='max-autotune', fullgraph=False)
+        scaler = torch.amp.GradScaler('cuda', enabled=use_cuda and not use_bf16)  # disabled scaler is a pass-through to backward() / optimizer.step()
 
         # -- loss & metric
         criterion = create_criterion(args.criterion)  # default: cross_entropy
 #         criterion = nn.CrossEntropyLoss(weight=torch.FloatTensor([1,1,20,1,1,20,1,1,20,1,1,20,1,1,20,1,1,20]).to(device))
-        opt_module = getattr(import_module("torch.optim"), args.optimizer)  # default: SGD
-        optimizer = opt_module(
-            filter(lambda p: p.requires_grad, model.parameters()),
-            lr=args.lr,
-            weight_decay=5e-4
-        )
+        opt_module = getattr(import_module("torch.optim"), args.optimizer)  # default: AdamW
+        params = [p for p in model.parameters() if p.requires_grad]
+        try:
+            # single fused kernel for the whole parameter update
+            optimizer = opt_module(params, lr=args.lr, weight_decay=5e-4, fused=use_cuda)
+        except (TypeError, RuntimeError):
+            # fused is not available for this optimizer / torch version
+            optimizer = opt_module(params, lr=args.lr, weight_decay=5e-4, foreach=True)
         scheduler = StepLR(optimizer, args.lr_decay_step, gamma=0.5)
 
         # -- logging
@@ -236,37 +389,42 @@ def train(data_dir, model_dir, args):
         for epoch in range(args.epochs):
             # train loop
             model.train()
-            loss_value = 0
-            matches = 0
+            # running sums stay on GPU, .item() only at log time to avoid a sync per step
+            loss_value = torch.zeros((), device=device)
+            matches = torch.zeros((), dtype=torch.long, device=device)
             list_labels = []
             list_preds = []
-            train_set.dataset.set_transform(transform['train']) # 
+            optimizer.zero_grad(set_to_none=True)
             for idx, train_batch in enumerate(train_loader):
                 inputs, labels = train_batch
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-
-                optimizer.zero_grad()
+                labels = labels.to(device, non_blocking=True)
+                inputs = inputs_to_device(inputs, device)
+                inputs = gpu_transform['train'](inputs / 255.0)
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
 
-                with torch.cuda.amp.autocast():
-                    outs = model(inputs)
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_cuda):
+                    outs = compiled_model(inputs)
                     preds = torch.argmax(outs, dim=-1)
                     loss = criterion(outs, labels)
 
-                list_labels.append(labels.detach().cpu().numpy())
-                list_preds.append(preds.detach().cpu().numpy())
+                # kept on GPU, copied to host only at log time to avoid a sync per step
+                list_labels.append(labels.detach())
+                list_preds.append(preds.detach())
 
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
+                # gradient accumulation : optimizer steps once every accum_steps batches
+                scaler.scale(loss / args.accum_steps).backward()
+                if (idx + 1) % args.accum_steps == 0:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
 
-                loss_value += loss.item()
-                matches += (preds == labels).sum().item()
+                loss_value += loss.detach().float()
+                matches += (preds == labels).sum()
                 if (idx + 1) % args.log_interval == 0:
-                    train_loss = loss_value / args.log_interval
-                    train_acc = matches / args.batch_size / args.log_interval
-                    tot_labels = np.concatenate(list_labels)
-                    tot_preds = np.concatenate(list_preds)
+                    train_loss = (loss_value / args.log_interval).item()
+                    train_acc = matches.item() / args.batch_size / args.log_interval
+                    tot_labels = torch.cat(list_labels).cpu().numpy()
+                    tot_preds = torch.cat(list_preds).cpu().numpy()
                     train_f1 = f1_score(tot_labels, tot_preds, average='macro')
                     current_lr = get_lr(optimizer)
                     print(
@@ -276,8 +434,14 @@ def train(data_dir, model_dir, args):
                     logger.add_scalar("Train/loss", train_loss, epoch * len(train_loader) + idx)
                     logger.add_scalar("Train/accuracy", train_acc, epoch * len(train_loader) + idx)
 
-                    loss_value = 0
-                    matches = 0
+                    loss_value.zero_()
+                    matches.zero_()
+
+            if len(train_loader) % args.accum_steps != 0:
+                # flush gradients of the last incomplete accumulation window
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
             scheduler.step()
 
@@ -285,42 +449,47 @@ def train(data_dir, model_dir, args):
             with torch.no_grad():
                 print("Calculating validation results...")
                 model.eval()
-                val_loss_items = []
-                val_acc_items = []
+                val_loss_sum = torch.zeros((), device=device)
+                val_acc_sum = torch.zeros((), dtype=torch.long, device=device)
                 list_labels = []
                 list_preds = []
 
-                figure = None
-                val_set.dataset.set_transform(transform['val'])
+                figure_batch = None
                 for val_batch in val_loader:
                     inputs, labels = val_batch
-                    inputs = inputs.to(device)
-                    labels = labels.to(device)
+                    labels = labels.to(device, non_blocking=True)
+                    inputs = inputs_to_device(inputs, device)
+                    inputs = gpu_transform['val'](inputs / 255.0)
+                    inputs = inputs.contiguous(memory_format=torch.channels_last)
 
-                    outs = model(inputs)
+                    outs = compiled_model(inputs)
                     preds = torch.argmax(outs, dim=-1)
 
-                    list_labels.append(labels.detach().cpu().numpy())
-                    list_preds.append(preds.detach().cpu().numpy())
-
-                    loss_item = criterion(outs, labels).item()
-                    acc_item = (labels == preds).sum().item()
-                    val_loss_items.append(loss_item)
-                    val_acc_items.append(acc_item)
-
-                    if figure is None:
-                        inputs_np = torch.clone(inputs).detach().cpu().permute(0, 2, 3, 1).numpy()
-                        inputs_np = MaskSplitByProfileDataset.denormalize_image(inputs_np, dataset.mean, dataset.std)
-                        figure = grid_image(
-                            inputs_np, labels, preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
-                        )
-
-                val_loss = np.sum(val_loss_items) / len(val_loader)
-                val_acc = np.sum(val_acc_items) / len(val_set)
-                tot_val_labels = np.concatenate(list_labels)
-                tot_val_preds = np.concatenate(list_preds)
+                    list_labels.append(labels.detach())
+                    list_preds.append(preds.detach())
+
+                    val_loss_sum += criterion(outs, labels).float()
+                    val_acc_sum += (labels == preds).sum()
+
+                    if figure_batch is None:
+                        figure_batch = inputs[:16], labels[:16], preds[:16]
+
+                val_loss = val_loss_sum.item() / len(val_loader)
+                val_acc = val_acc_sum.item() / len(val_set)
+                tot_val_labels = torch.cat(list_labels).cpu().numpy()
+                tot_val_preds = torch.cat(list_preds).cpu().numpy()
                 val_f1 = f1_score(tot_val_labels, tot_val_preds, average='macro')
 
+                # grid_image is diagnostics only, render it for the last epoch and new best models
+                figure = None
+                if epoch == args.epochs - 1 or val_f1 > best_f1:
+                    fig_inputs, fig_labels, fig_preds = figure_batch
+                    inputs_np = fig_inputs.detach().float().cpu().permute(0, 2, 3, 1).numpy()
+                    inputs_np = MaskSplitByProfileDataset.denormalize_image(inputs_np, dataset.mean, dataset.std)
+                    figure = grid_image(
+                        inputs_np, fig_labels, fig_preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
+                    )
+
                 if val_f1 > best_f1:
                     print(f"New best model for val f1 : {val_f1:4.2%}! saving the best model..")
                     torch.save(model.state_dict(), f"{save_dir}/best.pth")
@@ -329,8 +498,8 @@ def train(data_dir, model_dir, args):
                     best_f1 = val_f1
                 # ========== Error analysis code ==========
                     print(classification_report(tot_val_labels, tot_val_preds)) # For print in terminal
-                    rslt_f1_by_class = classification_report(tot_val_labels, tot_val_preds, output_dict=True) # For save as csv
-                    save_f1_result(epoch, rslt_f1_by_class, save_dir, save_best=True) # Save validation classification report
+                    precision, recall, f1, _ = precision_recall_fscore_support(tot_val_labels, tot_val_preds, labels=np.arange(num_classes), zero_division=0) # For save as csv
+                    save_f1_result(epoch, precision, recall, f1, save_dir, save_best=True) # Save validation classification report
                     save_best_val_pred(tot_val_labels, tot_val_preds, save_dir) # Save best validation prediction result
                 # ========== Error analysis code ==========
                 torch.save(model.state_dict(), f"{save_dir}/last.pth")
@@ -340,10 +509,18 @@ def train(data_dir, model_dir, args):
                 )
                 logger.add_scalar("Val/loss", val_loss, epoch)
                 logger.add_scalar("Val/accuracy", val_acc, epoch)
-                logger.add_figure("results", figure, epoch)
+                if figure is not None:
+                    logger.add_figure("results", figure, epoch)
                 print()
 
 
+def positive_int(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError(f"expected an integer >= 1, got {value}")
+    return ivalue
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
@@ -357,9 +534,10 @@ if __name__ == '__main__':
 #     parser.add_argument('--augmentation', type=str, default='BaseAugmentation', help='data augmentation type (default: BaseAugmentation)')
 #     parser.add_argument("--resize", nargs="+", type=list, default=[224, 224], help='resize size for image when training')
     parser.add_argument('--batch_size', type=int, default=64, help='input batch size for training (default: 64)')
+    parser.add_argument('--accum_steps', type=positive_int, default=1, help='number of batches to accumulate gradients over before each optimizer step (default: 1)')
     parser.add_argument('--valid_batch_size', type=int, default=64, help='input batch size for validing (default: 1000)')
 #     parser.add_argument('--model', type=str, default='BaseModel', help='model type (default: BaseModel)')
-    parser.add_argument('--optimizer', type=str, default='Adam', help='optimizer type (default: SGD)')
+    parser.add_argument('--optimizer', type=str, default='AdamW', help='optimizer type (default: AdamW)')
     parser.add_argument('--lr', type=float, default=1e-4, help='learning rate (default: 1e-3)')
     parser.add_argument('--val_ratio', type=float, default=0.2, help='ratio for validaton (default: 0.2)')
     parser.add_argument('--criterion', type=str, default='focal', help='criterion type (default: cross_entropy)')
@@ -369,6 +547,7 @@ if __name__ == '__main__':
 
     # Container environment
     parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images'))
+    parser.add_argument('--cache_dir', type=str, default=None, help='memmap cache built by cache_ensemble.py (default: None, decode JPEG on GPU)')
     parser.add_argument('--model_dir', type=str, default=os.environ.get('SM_MODEL_DIR', './model'))
 
     args = parser.parse_args()